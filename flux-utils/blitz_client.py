@@ -2,9 +2,12 @@
 
 import time
 import sys
+import math
+import struct
 import argparse
 import asyncio
 import contextlib
+from dataclasses import dataclass
 from bleak import BleakScanner, BleakClient, exc
 from third_party import dew_point, normalize_pressure, WatchDog
 
@@ -23,27 +26,18 @@ assert args.min_interval >= 60
 
 gatt_report = "0000f121-0000-1000-8000-00805f9b34fb"
 watch_dog = WatchDog(120, eprint)
+influx_queue = asyncio.Queue()
 
 
-class BLESensorStatus:
-    def __init__(self):
-        self.is_htu21d_online = False
-        self.is_bmp280_online = False
-        self.is_gy302_online = False
-        self.is_sht4x_online = False
-        self.is_end_of_battery = False
+STATUS_HTU21D = 0x80
+STATUS_BMP280 = 0x40
+STATUS_GY302 = 0x20
+STATUS_SHT4X = 0x10
+STATUS_LOW_BATTERY = 0x01
+STATUS_SENSORS = STATUS_HTU21D | STATUS_BMP280 | STATUS_GY302 | STATUS_SHT4X
 
-    def parse(self, data:int):
-        assert data >= 0 and data <= 255
-        self.is_htu21d_online = (data & 0x80) != 0
-        self.is_bmp280_online = (data & 0x40) != 0
-        self.is_gy302_online = (data & 0x20) != 0
-        self.is_sht4x_online = (data & 0x10) != 0
-        self.is_end_of_battery = (data & 0x01) != 0
-        assert not (self.is_htu21d_online and self.is_sht4x_online)
-
-    def __str__(self) -> str:
-        return f"HTU21D: {self.is_htu21d_online}, BMP280: {self.is_bmp280_online}, GY302: {self.is_gy302_online}, SHT4X: {self.is_sht4x_online}, Battery: {self.is_end_of_battery}"
+def status_str(status:int) -> str:
+    return f"HTU21D: {bool(status & STATUS_HTU21D)}, BMP280: {bool(status & STATUS_BMP280)}, GY302: {bool(status & STATUS_GY302)}, SHT4X: {bool(status & STATUS_SHT4X)}, Battery: {bool(status & STATUS_LOW_BATTERY)}"
 
 '''
 report data
@@ -57,58 +51,39 @@ report data
 14:15 gy302 light (*1.2)
 16    0x23
 '''
+_REPORT = struct.Struct("<xBHHHIhHx")
+# only the exact /65536 scales are folded, the rest stay divisions so values match to the last digit
+_HTU21D_T_SCALE = 175.72 / 65536.0
+_HTU21D_H_SCALE = 125.0 / 65536.0
+
+# parsed report, fields of offline sensors are nan
+@dataclass(slots=True)
+class Reading:
+    status: int
+    supply_voltage: float
+    temperature: float = math.nan
+    humidity: float = math.nan
+    pressure: float = math.nan
+    temperature_aux: float = math.nan
+    light: float = math.nan
+
 def parse_data(raw_data:bytearray, mask=0xff):
-    def supply_voltage(data:bytearray):
-        assert len(data) == 2
-        return int.from_bytes(data, byteorder='little', signed=False) / 1000.0
-    def htu21d_temperature(data:bytearray):
-        assert len(data) == 2
-        return int.from_bytes(data, byteorder='little', signed=False) * 175.72 / 65536.0 - 46.85
-    def htu21d_humidity(data:bytearray):
-        assert len(data) == 2
-        ans = int.from_bytes(data, byteorder='little', signed=False) * 125.0 / 65536.0 - 6.0
-        if ans > 100:
-            ans = 100.0
-        if ans < 0:
-            ans = 0.0
-        return ans
-    def sht4x_temperature(data:bytearray):
-        assert len(data) == 2
-        return int.from_bytes(data, byteorder='little', signed=False) * 175.0 / 65535.0 - 45.0
-    def sht4x_humidity(data:bytearray):
-        assert len(data) == 2
-        ans = int.from_bytes(data, byteorder='little', signed=False) * 125.0 / 65535.0 - 6.0
-        if ans > 100:
-            ans = 100.0
-        if ans < 0:
-            ans = 0.0
-        return ans
-    def bmp280_pressure(data:bytearray):
-        assert len(data) == 4
-        return int.from_bytes(data, byteorder='little', signed=False) / 25600.0
-    def bmp280_temperature(data:bytearray):
-        assert len(data) == 2
-        return int.from_bytes(data, byteorder='little', signed=True) / 100.0
-    def gy302_light(data:bytearray):
-        assert len(data) == 2
-        return int.from_bytes(data, byteorder='little', signed=False) / 1.2
     assert len(raw_data) == 17
-    ans = {}
-    ble_sensor_status = BLESensorStatus()
-    ble_sensor_status.parse(raw_data[1] & mask)
-    ans["status"] = ble_sensor_status
-    ans["supply_voltage"] = supply_voltage(raw_data[2:4])
-    if ble_sensor_status.is_sht4x_online:
-        ans["temperature"] = sht4x_temperature(raw_data[4:6])
-        ans["humidity"] = sht4x_humidity(raw_data[6:8])
-    elif ble_sensor_status.is_htu21d_online:
-        ans["temperature"] = htu21d_temperature(raw_data[4:6])
-        ans["humidity"] = htu21d_humidity(raw_data[6:8])
-    if ble_sensor_status.is_bmp280_online:
-        ans["pressure"] = bmp280_pressure(raw_data[8:12])
-        ans["temperature_aux"] = bmp280_temperature(raw_data[12:14])
-    if ble_sensor_status.is_gy302_online:
-        ans["light"] = gy302_light(raw_data[14:16])
+    status, vraw, traw, hraw, praw, taux_raw, lraw = _REPORT.unpack(raw_data)
+    status &= mask
+    assert not (status & STATUS_HTU21D and status & STATUS_SHT4X)
+    ans = Reading(status, vraw / 1000.0)
+    if status & STATUS_SHT4X:
+        ans.temperature = traw * 175.0 / 65535.0 - 45.0
+        ans.humidity = min(max(hraw * 125.0 / 65535.0 - 6.0, 0.0), 100.0)
+    elif status & STATUS_HTU21D:
+        ans.temperature = traw * _HTU21D_T_SCALE - 46.85
+        ans.humidity = min(max(hraw * _HTU21D_H_SCALE - 6.0, 0.0), 100.0)
+    if status & STATUS_BMP280:
+        ans.pressure = praw / 25600.0
+        ans.temperature_aux = taux_raw / 100.0
+    if status & STATUS_GY302:
+        ans.light = lraw / 1.2
     return ans
 
 
@@ -131,108 +106,214 @@ async def scan(address=None):
 
 
 def debug_print(sensor, data):
-    ans = str(data["status"]) + f", Supply voltage: {data['supply_voltage']} V"
-    if data["status"].is_sht4x_online:
-        ans += f", SHT4X: {data['temperature']} C, {data['humidity']} %"
-    elif data["status"].is_htu21d_online:
-        ans += f", HTU21D: {data['temperature']} C, {data['humidity']} %"
-    if data["status"].is_bmp280_online:
-        ans += f", BMP280: {data['pressure']} hPa, {data['temperature_aux']} C"
-    if data["status"].is_gy302_online:
-        ans += f", GY302: {data['light']} lux"
+    ans = status_str(data.status) + f", Supply voltage: {data.supply_voltage} V"
+    if data.status & STATUS_SHT4X:
+        ans += f", SHT4X: {data.temperature} C, {data.humidity} %"
+    elif data.status & STATUS_HTU21D:
+        ans += f", HTU21D: {data.temperature} C, {data.humidity} %"
+    if data.status & STATUS_BMP280:
+        ans += f", BMP280: {data.pressure} hPa, {data.temperature_aux} C"
+    if data.status & STATUS_GY302:
+        ans += f", GY302: {data.light} lux"
     eprint(f"{sensor}: {ans}")
 
 
-def influx_print(sensor, data):
-    timestamp = int(time.time() * 1000000000)
-    measurement = f"blitz,sensor={sensor}"
-    print(f"{measurement} supply_voltage={data['supply_voltage']} {timestamp}", flush=True)
-    if data["status"].is_htu21d_online or data["status"].is_sht4x_online:
-        print(f"{measurement} temperature={data['temperature']},humidity={data['humidity']} {timestamp}", flush=True)
-    if data["status"].is_bmp280_online:
-        print(f"{measurement} pressure={data['pressure']} {timestamp}", flush=True)
+def _influx_template(sensors:int) -> str:
+    measurement = "blitz,sensor={sensor}"
+    lines = [f"{measurement} supply_voltage={{data.supply_voltage}} {{timestamp}}\n"]
+    if sensors & (STATUS_HTU21D | STATUS_SHT4X):
+        lines.append(f"{measurement} temperature={{data.temperature}},humidity={{data.humidity}} {{timestamp}}\n")
+    if sensors & STATUS_BMP280:
+        lines.append(f"{measurement} pressure={{data.pressure}} {{timestamp}}\n")
         if args.altitude:
-            print(f"{measurement} pressure_normalized={normalize_pressure(data['pressure'], args.altitude)} {timestamp}", flush=True)
-        temp_tag = "temperature_aux" if data["status"].is_htu21d_online or data["status"].is_sht4x_online else "temperature"
-        print(f"{measurement} {temp_tag}={data['temperature_aux']} {timestamp}", flush=True)
-    if "temperature" in data and "pressure" in data and "humidity" in data:
-        print(f"{measurement} dew_point={dew_point(data['temperature'], data['pressure'], data['humidity'])} {timestamp}", flush=True)
-    if data["status"].is_gy302_online:
-        print(f"{measurement} light={data['light']} {timestamp}", flush=True)
+            lines.append(f"{measurement} pressure_normalized={{pressure_normalized}} {{timestamp}}\n")
+        temp_tag = "temperature_aux" if sensors & (STATUS_HTU21D | STATUS_SHT4X) else "temperature"
+        lines.append(f"{measurement} {temp_tag}={{data.temperature_aux}} {{timestamp}}\n")
+    if sensors & STATUS_GY302:
+        lines.append(f"{measurement} light={{data.light}} {{timestamp}}\n")
+    return "".join(lines)
+
+# one template for every combination of the sensor bits
+_TEMPLATES = {sensors: _influx_template(sensors) for sensors in range(0, STATUS_SENSORS + 1, 0x10)}
+_DEW_POINT_TEMPLATE = "blitz,sensor={sensor} dew_point={dew_point} {timestamp}\n"
+
+
+def influx_print(sensor, data):
+    sensors = data.status & STATUS_SENSORS
+    timestamp = time.time_ns()
+    pressure_normalized = None
+    if sensors & STATUS_BMP280 and args.altitude:
+        pressure_normalized = normalize_pressure(data.pressure, args.altitude)
+    out = _TEMPLATES[sensors].format(data=data, sensor=sensor, timestamp=timestamp, pressure_normalized=pressure_normalized)
+    # skipped at 0 % humidity, where the dew point is undefined
+    if sensors & STATUS_BMP280 and sensors & (STATUS_HTU21D | STATUS_SHT4X) and data.humidity > 0:
+        dp = dew_point(data.temperature, data.pressure, data.humidity)
+        out += _DEW_POINT_TEMPLATE.format(sensor=sensor, dew_point=dp, timestamp=timestamp)
+    influx_queue.put_nowait(out)
+
+
+# frames of all sensors arriving within window are written together
+async def influx_writer(window=0.05):
+    while True:
+        lines = [await influx_queue.get()]
+        await asyncio.sleep(window)
+        while not influx_queue.empty():
+            lines.append(influx_queue.get_nowait())
+        sys.stdout.write("".join(lines))
+        sys.stdout.flush()
 
 
-async def blitz_access(name, address, lock, latency, mask=0xff):
+async def blitz_access(name, address, discover_sem, latency, mask=0xff):
     def named_print(*args, **kwargs):
         eprint(f"[{name}]", *args, **kwargs)
     def cb(client):
         named_print(f"Disconnected callback")
+    def is_valid(raw_data):
+        return len(raw_data) == 17 and raw_data[0] == 0x12 and raw_data[16] == 0x23
+    def handle_data(raw_data):
+        nonlocal worked, timeout_count
+        data = parse_data(raw_data, mask)
+        if not worked:
+            worked = True
+            named_print(f"Successfully got data")
+        if not data.status & STATUS_SENSORS:
+            named_print(f"WARNING: No sensor online!")
+        if data.status & STATUS_LOW_BATTERY:
+            named_print(f"WARNING: Low battery!")
+        if args.debug:
+            debug_print(name, data)
+        influx_print(name, data)
+        timeout_count = 0
+    def notify_cb(sender, raw_data):
+        nonlocal worked, last_notify, last_emit, last_not_ready, notified, notify_error
+        if notify_stop.is_set():
+            return
+        last_notify = time.time()
+        notified = True
+        if not is_valid(raw_data):
+            worked = False
+            if raw_data == b"\x00" * 17:
+                # log at the pace of the poll path's back-off, not per notification
+                if last_notify - last_not_ready >= 30:
+                    last_not_ready = last_notify
+                    named_print(f"Device is not ready, waiting for valid data")
+            else:
+                named_print(f"Invalid data: {raw_data}")
+            return
+        if last_notify - last_emit < args.min_interval:
+            return
+        last_emit = last_notify
+        # bleak only logs what a callback raises, hand it to subscribe instead so
+        # the session ends the same way as on the poll path
+        try:
+            handle_data(raw_data)
+        except Exception as e:
+            named_print(f"Failed handling data. Error {type(e)}: {str(e)}")
+            notify_error = e
+            notify_stop.set()
+    async def subscribe(client):
+        nonlocal last_notify, notified, use_notify, notify_error, notify_stop
+        last_notify = time.time()
+        notified = False
+        notify_error = None
+        notify_stop = asyncio.Event()
+        await client.start_notify(gatt_report, notify_cb)
+        named_print(f"Subscribed to notifications")
+        while client.is_connected:
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(notify_stop.wait(), 10)
+            if notify_error is not None:
+                raise notify_error
+            if time.time() - last_notify > 2 * args.min_interval:
+                named_print(f"No notification for {2 * args.min_interval} seconds")
+                break
+        if client.is_connected and not notified:
+            # the characteristic lists notify but the firmware never sends any
+            named_print(f"Notifications not supported, polling from now on")
+            use_notify = False
+            await client.stop_notify(gatt_report)
+            await poll(client)
+    async def poll(client):
+        nonlocal worked
+        while client.is_connected:
+            start_time = time.time()
+            try:
+                raw_data = await client.read_gatt_char(gatt_report)
+            except Exception as e:
+                if "Not connected" in str(e):
+                    break
+                named_print(f"Failed reading data, retrying in 3 seconds. Error {type(e)}: {str(e)}")
+                worked = False
+                await asyncio.sleep(3)
+                continue
+            if not is_valid(raw_data):
+                named_print(f"Invalid data: {raw_data}")
+                if raw_data == b"\x00" * 17:
+                    named_print(f"Device is not ready, retrying in 30 seconds")
+                    await asyncio.sleep(30)
+                worked = False
+                continue
+            handle_data(raw_data)
+            sleep_time = args.min_interval - (time.time() - start_time)
+            if sleep_time > 0:
+                await asyncio.sleep(sleep_time)
+    async def session():
+        nonlocal timeout_count
+        async with contextlib.AsyncExitStack() as stack:
+            # scanning is serial on one adapter, connected clients are not
+            async with discover_sem:
+                named_print(f"Scanning...")
+                # bound every step so a hiccup is retried right away. the watch
+                # dog stays as the last resort in case cancelling hangs too
+                with watch_dog.watch():
+                    async with asyncio.timeout(30):
+                        device = await BleakScanner.find_device_by_address(address, timeout=20)
+            if device is None:
+                raise exc.BleakDeviceNotFoundError(f"Device {address} not found")
+            named_print(f"Found {device.name}, connecting...")
+            client = BleakClient(device, timeout=60, disconnected_callback=cb)
+            with watch_dog.watch():
+                async with asyncio.timeout(70):
+                    await stack.enter_async_context(client)
+            named_print(f"Connected")
+            timeout_count = 0
+            # notifications cost one packet on air, a read is a full request/response
+            char = client.services.get_characteristic(gatt_report)
+            if use_notify and char is not None and "notify" in char.properties:
+                await subscribe(client)
+            else:
+                await poll(client)
     await asyncio.sleep(latency)
     named_print(f"Job started for {address} with mask {mask}")
     timeout_count = 0
+    last_notify = 0
+    last_emit = 0
+    last_not_ready = 0
+    notified = False
+    notify_error = None
+    notify_stop = asyncio.Event()
+    use_notify = True
     while True:
         worked = False
         try:
             named_print(f"Will connect to {address}")
-            async with contextlib.AsyncExitStack() as stack:
-                async with lock:
-                    named_print(f"Scanning...")
-                    # may hang, may be a bug. so use a custom watch dog
-                    watch_dog.on()
-                    device = await BleakScanner.find_device_by_address(address, timeout=20)
-                    watch_dog.off()
-                    if device is None:
-                        raise exc.BleakDeviceNotFoundError(f"Device {address} not found")
-                    named_print(f"Found {device.name}, connecting...")
-                    client = BleakClient(device, timeout=60, disconnected_callback=cb)
-                    watch_dog.on()
-                    await stack.enter_async_context(client)
-                    watch_dog.off()
-            # async with BleakClient(address, timeout=60, disconnected_callback=cb) as client:
-                named_print(f"Connected")
-                while True:
-                    if not client.is_connected:
-                        break
-                    start_time = time.time()
-                    try:
-                        async with lock:
-                            raw_data = await client.read_gatt_char(gatt_report)
-                    except Exception as e:
-                        if "Not connected" in str(e):
-                            break
-                        named_print(f"Failed reading data, retrying in 3 seconds. Error {type(e)}: {str(e)}")
-                        worked = False
-                        await asyncio.sleep(3)
-                        continue
-                    if len(raw_data) != 17 or raw_data[0] != 0x12 or raw_data[16] != 0x23:
-                        named_print(f"Invalid data: {raw_data}")
-                        if raw_data == b"\x00" * 17:
-                            named_print(f"Device is not ready, retrying in 30 seconds")
-                            await asyncio.sleep(30)
-                        worked = False
-                        continue
-                    data = parse_data(raw_data, mask)
-                    if not worked:
-                        worked = True
-                        named_print(f"Successfully got data")
-                    if not data["status"].is_sht4x_online and not data["status"].is_htu21d_online and not data["status"].is_bmp280_online and not data["status"].is_gy302_online:
-                        named_print(f"WARNING: No sensor online!")
-                    if data["status"].is_end_of_battery:
-                        named_print(f"WARNING: Low battery!")
-                    if args.debug:
-                        debug_print(name, data)
-                    influx_print(name, data)
-                    timeout_count = 0
-                    sleep_time = args.min_interval - (time.time() - start_time)
-                    if sleep_time > 0:
-                        await asyncio.sleep(sleep_time)
+            await session()
             named_print(f"Disconnected, retrying in 3 seconds")
             await asyncio.sleep(3)
-        except Exception as e:
-            watch_dog.off()
-            if isinstance(e, exc.BleakDeviceNotFoundError):
-                named_print(f"{address} not found, retrying in 60 seconds")
+        except TimeoutError:
+            timeout_count += 1
+            if timeout_count > 10:
+                named_print(f"Too many timeouts, wait 60 seconds")
+                timeout_count = 0
                 await asyncio.sleep(60)
-            elif "No powered Bluetooth adapters found" in str(e):
+            else:
+                named_print(f"Timed out, retrying in 3 seconds")
+                await asyncio.sleep(3)
+        except exc.BleakDeviceNotFoundError:
+            named_print(f"{address} not found, retrying in 60 seconds")
+            await asyncio.sleep(60)
+        except Exception as e:
+            if "No powered Bluetooth adapters found" in str(e):
                 named_print(f"No available BT adapters, retrying in 60 seconds")
                 await asyncio.sleep(60)
             elif "[org.bluez.Error.InProgress]" in str(e):
@@ -240,21 +321,13 @@ async def blitz_access(name, address, lock, latency, mask=0xff):
                 await asyncio.sleep(20)
             else:
                 named_print(f"Failed connecting, retrying in 3 seconds. Error {type(e)}: {str(e)}")
-                if isinstance(e, asyncio.exceptions.TimeoutError):
-                    timeout_count += 1
-                    if timeout_count > 10:
-                        named_print(f"Too many timeouts, wait 60 seconds")
-                        await asyncio.sleep(60)
-                        # await scan(address)
-                        # timeout_count = 0
                 await asyncio.sleep(3)
 
 async def main():
     if args.scan:
         await scan()
-    tasks = []
-    lock = asyncio.Lock()
-    for index, sensor in enumerate(args.sensors):
+    sensors = []
+    for sensor in args.sensors:
         sensor_info = sensor.strip().split(",")
         if len(sensor_info) == 1:
             address = sensor_info[0]
@@ -269,13 +342,16 @@ async def main():
         else:
             eprint(f"Invalid sensor format {sensor}")
             exit(1)
-        tasks.append(asyncio.create_task(blitz_access(name, address, lock=lock, latency=index*20, mask=mask)))
-    if tasks:
-        tasks.append(asyncio.create_task(watch_dog.loop()))
-        await asyncio.wait(tasks)
-    else:
+        sensors.append((name, address, mask))
+    if not sensors:
         eprint("No sensor specified")
         exit(1)
+    discover_sem = asyncio.Semaphore(1)
+    async with asyncio.TaskGroup() as tg:
+        for index, (name, address, mask) in enumerate(sensors):
+            tg.create_task(blitz_access(name, address, discover_sem=discover_sem, latency=index*20, mask=mask))
+        tg.create_task(watch_dog.loop())
+        tg.create_task(influx_writer())
 
 if __name__ == "__main__":
     asyncio.run(main())
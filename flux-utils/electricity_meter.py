@@ -4,8 +4,10 @@
 import time
 import sys
 import argparse
+import struct
 import serial
 import asyncio
+from dataclasses import dataclass
 from third_party import WatchDog
 
 
@@ -24,46 +26,56 @@ def eprint(*args, **kwargs):
 
 watch_dog = WatchDog(120, eprint)
 
+'''
+report data (big endian)
+0:4   0xff 0x55 0x01 0x01
+5:6   voltage (*10)
+8:9   current (*1000)
+11:12 power (*10)
+15:16 kwh (*100)
+19    price (*100)
+20:21 frequency (*10)
+22:23 power factor (*1000)
+25    temperature
+26:27 hours
+28    minutes
+29    seconds
+'''
+_HEADER = b"\xff\x55\x01\x01"
+_FRAME = struct.Struct(">5xHxHxH2xH2xBHHxBHBB")
+
+@dataclass(slots=True)
+class Reading:
+    voltage: float
+    current: float
+    power: float
+    kwh: float
+    price: float
+    freq: float
+    coef: float
+    temperature: int
+    h: int
+    m: int
+    s: int
+
 def parse_data(raw_data):
-    voltage = int.from_bytes(raw_data[5:7], "big") / 10.0
-    current = int.from_bytes(raw_data[8:10], "big") / 1000.0
-    power = int.from_bytes(raw_data[11:13], "big") / 10.0
-    kwh = int.from_bytes(raw_data[15:17], "big") / 100.0
-    price = int.from_bytes(raw_data[19:20], "big") / 100.0
-    freq = int.from_bytes(raw_data[20:22], "big") / 10.0
-    coef = int.from_bytes(raw_data[22:24], "big") / 1000.0
-    temperature = int.from_bytes(raw_data[25:26], "big")
-    h = int.from_bytes(raw_data[26:28], "big")
-    m = int.from_bytes(raw_data[28:29], "big")
-    s = int.from_bytes(raw_data[29:30], "big")
-    ans = {
-        "voltage": voltage,
-        "current": current,
-        "power": power,
-        "kwh": kwh,
-        "price": price,
-        "freq": freq,
-        "coef": coef,
-        "temperature": temperature,
-        "h": h,
-        "m": m,
-        "s": s,
-    }
-    return ans
+    voltage, current, power, kwh, price, freq, coef, temperature, h, m, s = _FRAME.unpack_from(raw_data)
+    return Reading(voltage / 10.0, current / 1000.0, power / 10.0, kwh / 100.0, price / 100.0, freq / 10.0, coef / 1000.0,
+                   temperature, h, m, s)
 
 
 def debug_print(data):
     eprint(
-        f'{data["voltage"]}V {data["current"]}A {data["power"]}W {data["coef"]} {data["freq"]}Hz {data["kwh"]}kwh {data["temperature"]}c {data["h"]}:{data["m"]}:{data["s"]} ￥{data["price"]}'
+        f'{data.voltage}V {data.current}A {data.power}W {data.coef} {data.freq}Hz {data.kwh}kwh {data.temperature}c {data.h}:{data.m}:{data.s} ￥{data.price}'
     )
 
 
 def influx_print(data):
     timestamp = str(int(time.time())) + "000000000"
-    print(
-        f"electricity_meter voltage={data['voltage']},current={data['current']},power={data['power']},electricity={data['kwh']},frequency={data['freq']},factor={data['coef']},temperature={data['temperature']} {timestamp}",
-        flush=True,
+    sys.stdout.write(
+        f"electricity_meter voltage={data.voltage},current={data.current},power={data.power},electricity={data.kwh},frequency={data.freq},factor={data.coef},temperature={data.temperature} {timestamp}\n"
     )
+    sys.stdout.flush()
 
 
 def run_spp(path):
@@ -76,7 +88,7 @@ def run_spp(path):
         raw_data = ser.read(36)
         if len(raw_data) == 0:
             raw_data = ser.read(36)
-        if len(raw_data) < 32 or raw_data[0:4] != b"\xff\x55\x01\x01":
+        if len(raw_data) < 32 or not raw_data.startswith(_HEADER):
             worked = False
             if reconnect_count > reconnect_threshold:
                 raise serial.SerialException("too many errors")
@@ -123,7 +135,7 @@ async def run_ble(address):
         watch_dog.touch()
         nonlocal print_count
         nonlocal worked
-        if len(data) == 36 and data[0:4] == b"\xff\x55\x01\x01":
+        if len(data) == 36 and data.startswith(_HEADER):
             data = parse_data(data)
             if not worked:
                 eprint("Successfully got data")
@@ -1,6 +1,8 @@
 from .humidity import rel_to_dpt
 import time
 import asyncio
+import contextlib
+from functools import lru_cache
 
 def cel_to_kel(T):
     return T + 273.15
@@ -12,7 +14,9 @@ def kel_to_cel(T):
 def dew_point(T, P, RH):
     return kel_to_cel(rel_to_dpt(cel_to_kel(T), P * 100, RH))
 
-def normalize_pressure(P, altitude):
+# reference pressure at altitude in hPa, altitude is fixed per process
+@lru_cache(maxsize=4)
+def _p1_hpa(altitude):
     g0 = 9.80665
     R = 8.3144598
     M = 0.0289644
@@ -20,13 +24,19 @@ def normalize_pressure(P, altitude):
     Lb = 0.0065
     P0 = 101325.00
     P1 = P0 * ((Tb - altitude * Lb) / Tb) ** (g0 * M / R / Lb)
-    return P - P1 / 100
+    return P1 / 100
+
+def normalize_pressure(P, altitude):
+    return P - _p1_hpa(altitude)
 
 class WatchDog:
     def __init__(self, timeout=60, print_func=print):
         self.timeout = timeout
         self.ts = time.time()
         self.enable = False
+        # deadlines of the steps currently inside watch(), one per caller so
+        # concurrent tasks neither turn off nor reset each other's timer
+        self.deadlines = {}
         self.eprint = print_func
 
     def on(self):
@@ -39,14 +49,26 @@ class WatchDog:
     def touch(self):
         self.ts = time.time()
 
+    @contextlib.contextmanager
+    def watch(self):
+        token = object()
+        self.deadlines[token] = time.time() + self.timeout
+        try:
+            yield
+        finally:
+            del self.deadlines[token]
+
     async def loop(self):
         while True:
-            if not self.enable:
+            deadlines = list(self.deadlines.values())
+            if self.enable:
+                deadlines.append(self.ts + self.timeout)
+            if not deadlines:
                 await asyncio.sleep(self.timeout / 2)
                 continue
-            time_expire = time.time() - self.ts
-            if time_expire >= self.timeout:
-                self.eprint(f"Watch dog timed out for {time_expire}s")
+            time_left = min(deadlines) - time.time()
+            if time_left <= 0:
+                self.eprint(f"Watch dog timed out for {self.timeout - time_left}s")
                 exit(-1)
             else:
-                await asyncio.sleep(self.timeout - time_expire)
+                await asyncio.sleep(time_left)
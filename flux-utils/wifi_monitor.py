@@ -3,7 +3,7 @@
 import time
 import argparse
 import sys
-from dateutil import parser as date_parser
+from datetime import datetime
 
 
 parser = argparse.ArgumentParser(description='Report WiFi Scan Result')
@@ -15,10 +15,22 @@ def eprint(*args, **kwargs):
 
 log_path = f'/dev/shm/flux_wifi_monitor-01.csv'
 
+def parse_timestamp(s):
+    try:
+        return datetime.fromisoformat(s).timestamp()
+    except ValueError:
+        # only needed for unexpected formats, keep it off the startup path
+        from dateutil import parser as date_parser
+        return date_parser.parse(s).timestamp()
+
 def run():
     ap_counter = 0
     station_counter = 0
     section = 'ap'
+    now = time.time()
+    # airodump-ng writes "YYYY-MM-DD HH:MM:SS", entries from before the window can
+    # be skipped on their date alone
+    oldest_day = datetime.fromtimestamp(now - args.berlin).strftime('%Y-%m-%d')
     with open(log_path, 'r') as f:
         for line in f:
             line = line.strip()
@@ -29,14 +41,16 @@ def run():
             elif line.startswith('Station'):
                 section = 'station'
             else:
-                last_time = line.split(',')[2]
-                if time.time() - date_parser.parse(last_time).timestamp() > args.berlin:
+                last_time = line.split(',')[2].strip()
+                if last_time[4:5] == '-' and last_time[:10] < oldest_day:
+                    continue
+                if now - parse_timestamp(last_time) > args.berlin:
                     continue
                 if section == 'ap':
                     ap_counter += 1
                 elif section == 'station':
                     station_counter += 1
-    timestamp = str(int(time.time())) + "000000000"
+    timestamp = str(int(now)) + "000000000"
     if ap_counter > 0 or station_counter > 0:
         print(f"wifi_monitor ap_count={ap_counter}i,station_count={station_counter}i {timestamp}")
     else: